@@ -7,11 +7,12 @@ Convert existing jupyter notebook to an airbnb knowledge repo format
 Deploying the webapp
 - knowledge_repo --repo knowledge-repo deploy
 """
+import io
 import os
 import re
 import json
-import subprocess
-from dateutil import parser as date_parser
+from functools import lru_cache
+from collections import deque
 
 
 def main(ml_repo, knowledge_repo, inplace):
@@ -20,31 +21,135 @@ def main(ml_repo, knowledge_repo, inplace):
     if not os.path.isdir(knowledge_repo_path):
         init_knowledge_repo(knowledge_repo_path)
 
-    convert_all_posts(ml_repo_path, knowledge_repo_path, inplace)
+    date_index = IpynbConverter.prebuild_date_index(ml_repo_path)
+    entries = convert_all_posts(ml_repo_path, knowledge_repo_path, inplace, date_index)
+    IpynbConverter.flush(knowledge_repo_path, entries)
 
 
 def init_knowledge_repo(path):
-    cmd = 'knowledge_repo --repo {} init'.format(path)
-    subprocess.call(cmd, shell=True)
+    import subprocess
 
+    cmd = ['knowledge_repo', '--repo', path, 'init']
+    subprocess.run(cmd, check=False)
 
-def convert_all_posts(path, knowledge_repo_path, inplace):
-    """Recursive walk down all directory to perform the conversion"""
-    if os.path.isdir(path):
-        files = [os.path.join(path, f) for f in os.listdir(path)]
-        for f in files:
-            convert_all_posts(f, knowledge_repo_path, inplace)
 
-    elif '-converted' not in path:
-        head, ext = os.path.splitext(path)
-        if ext == ".ipynb":
-            try:
-                converter = IpynbConverter(knowledge_repo_path, inplace)
-                notebook = converter.convert(path)
-                converter.add(notebook)
-            except Exception as e:
-                print('Skipping: {}'.format(path))
-                print(e)
+def convert_all_posts(path, knowledge_repo_path, inplace, date_index=None):
+    """
+    Convert all the notebooks under the directory in parallel, returns the
+    converted notebooks' (path, destination, inplace) entries, to be added
+    to the knowledge repo by IpynbConverter.flush
+
+    If a worker process dies abruptly (e.g. runs out of memory on a large
+    notebook), the notebooks that didn't finish converting before that are
+    skipped. Note that with inplace, some of those may already be rewritten
+    without being returned, thus they won't be added to the knowledge repo.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    paths = list(find_notebooks(path))
+    entries = []
+    skipped = []
+    try:
+        with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                 initializer=_init_worker,
+                                 initargs=(path, knowledge_repo_path, inplace, date_index)) as executor:
+            # submit each notebook on its own, so the notebooks that finished
+            # converting are still collected if the pool breaks midway
+            futures = [executor.submit(_convert_one, notebook_path) for notebook_path in paths]
+            for notebook_path, future in zip(paths, futures):
+                try:
+                    entry = future.result()
+                except BrokenProcessPool as e:
+                    print('Skipping: {}'.format(notebook_path))
+                    print(e)
+                    skipped.append(notebook_path)
+                    continue
+
+                if entry is not None:
+                    entries.append(entry)
+    except BaseException:
+        # nothing will be added to the knowledge repo, clean up every copy
+        if not inplace:
+            _remove_converted(paths)
+        raise
+
+    # the skipped notebooks may have been written before their worker died
+    if not inplace:
+        _remove_converted(skipped)
+
+    return entries
+
+
+def find_notebooks(path):
+    """Walk down all directory to find the notebooks that are not converted yet"""
+    # iterative walk using an explicit stack, scandir's DirEntry
+    # caches the file type so we don't need an extra stat call per entry
+    stack = deque([path])
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.ipynb') and '-converted' not in entry.name:
+                    yield entry.path
+
+
+# arguments shared by every notebook conversion, set once per worker process
+# by _init_worker so the date index isn't pickled for every notebook
+_worker_args = None
+
+
+def _init_worker(ml_repo_path, knowledge_repo_path, inplace, date_index):
+    global _worker_args
+    _worker_args = ml_repo_path, knowledge_repo_path, inplace, date_index
+
+
+@lru_cache(maxsize=None)
+def _import_orjson():
+    """
+    orjson is optional and slow to import, import it on first use and cache
+    the result, so a missing orjson isn't looked up again for every notebook
+    """
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    return orjson
+
+
+def _converted_path(path):
+    """Path of the notebook's converted copy when the conversion isn't inplace"""
+    head, ext = os.path.splitext(path)
+    return head + '-converted' + ext
+
+
+def _remove_converted(paths):
+    """Remove the notebooks' converted copies that were written"""
+    for path in paths:
+        converted_path = _converted_path(path)
+        if os.path.exists(converted_path):
+            os.remove(converted_path)
+
+
+def _convert_one(path):
+    """
+    Convert a single notebook inside a worker process, returns the
+    notebook's (path, destination, inplace) entry for IpynbConverter.flush
+    or None if the conversion failed.
+    """
+    converter = IpynbConverter(*_worker_args)
+    try:
+        notebook = converter.convert(path)
+        return converter.add(notebook)
+    except Exception as e:
+        print('Skipping: {}'.format(path))
+        print(e)
+        if not converter.inplace:
+            _remove_converted([path])
+
+        return None
 
 
 class IpynbConverter:
@@ -53,13 +158,22 @@ class IpynbConverter:
 
     Parameters
     ----------
+    ml_repo_path : str
+        Path to the root directory of the machine-learning repo.
+
     knowledge_repo_path : str
         Path to store the airbnb knowledge repo-ed notebook.
 
     inplace : bool
         Whether to perform the conversion inplace or not. If
         false, then it will create a new notebook that has the
-        '-converted' appended to the file name.
+        '-converted' appended to the file name, which is removed
+        once it's added to the knowledge repo.
+
+    date_index : dict or None, default None
+        Mapping of the notebook's absolute path to its (date_created, date_updated)
+        tuple, as returned by the .prebuild_date_index method. Notebooks that are
+        not in the index fall back to running git log on the notebook itself.
 
     Attributes
     ----------
@@ -81,7 +195,8 @@ class IpynbConverter:
         Notebook's title, uses the first level 1 markdown header that's not
         'Table of Contents' that could be automatically generated by newer
         version of notebook. e.g. # Decision Tree (Classification)\n, then
-        Decision Tree (Classification) would be our title.
+        Decision Tree (Classification) would be our title. If none of the
+        first few markdown cells has one, the tag is used as the title.
 
     References
     ----------
@@ -90,14 +205,106 @@ class IpynbConverter:
     """
 
     AUTHOR = 'Ethen Liu'
-    DATE_FORMAT = '%Y-%m-%d'
     REPO_NAME = 'machine-learning'
     BASE_URL = 'https://github.com/ethen8181/'
 
-    def __init__(self, knowledge_repo_path, inplace):
+    # header text required by the knowledge repo, the fields are
+    # filled in per notebook by ._construct_header;
+    # a '- ' in front is required for knowledge repo tag
+    HEADER_TEMPLATE = (
+        '---\n',
+        'title: {title}\n',
+        'authors:\n',
+        '- {author}\n',
+        'tags:\n',
+        '- {tags}\n',
+        'created_at: {date_created}\n',
+        'updated_at: {date_updated}\n',
+        'tldr: Nothing for tldr section as of now.\n',
+        '---')
+    GITHUB_LINK_PREFIX = 'Link to original notebook: '
+
+    # locates the start of the top-level cells list in the notebook's raw json,
+    # nbformat sorts the top-level keys so 'cells' is expected to be the first one
+    CELLS_PATTERN = re.compile(rb'\A\s*\{\s*"cells"\s*:\s*\[')
+    EMPTY_CELLS_PATTERN = re.compile(rb'\s*\]')
+
+    COMMIT_MESSAGE = 'generated by automated airbnb knowledge repo setup'
+
+    # the title is expected within the first few markdown cells,
+    # stop looking after this many instead of scanning the whole notebook
+    # and use the file name as the title instead
+    TITLE_MAX_MARKDOWN_CELLS = 3
+
+    def __init__(self, ml_repo_path, knowledge_repo_path, inplace, date_index=None):
         self.inplace = inplace
+        self.ml_repo_path = ml_repo_path
+        self.date_index = date_index
         self.knowledge_repo_path = knowledge_repo_path
 
+        # the notebook's path relative to the repo is appended to these
+        # to form the github link, /blob/master indicates github master branch
+        self._repo_prefix = os.path.abspath(ml_repo_path)
+        self._base_link = self.BASE_URL + self.REPO_NAME + '/blob/master'
+
+    @classmethod
+    def prebuild_date_index(cls, repo_root):
+        """
+        Walk the git history once to collect the creation and latest updated
+        date of every notebook under the repo, instead of running two
+        git log commands per notebook.
+
+        Parameters
+        ----------
+        repo_root : str
+            Path to the root directory of the machine-learning repo.
+
+        Returns
+        -------
+        date_index : dict
+            Mapping of the notebook's absolute path to its
+            (date_created, date_updated) tuple. Empty if the git log
+            command fails, e.g. repo_root isn't inside a git repo, in
+            which case every notebook falls back to its own git log.
+        """
+        import subprocess
+
+        repo_root = os.path.abspath(repo_root)
+
+        # each commit is printed as a '\0'-prefixed ISO 8601 committer date,
+        # followed by the notebooks that were added or modified in it;
+        # --relative makes the file names relative to repo_root; --no-renames
+        # skips git's rename detection, a renamed notebook is simply listed as
+        # added under its new name, which is the only name the conversion uses
+        cmd = ['git', '-C', repo_root, '-c', 'core.quotepath=off', 'log',
+               '--relative', '--name-only', '--no-renames', '--diff-filter=AM',
+               '--format=%x00%cI', '--', '*.ipynb']
+        try:
+            output = subprocess.check_output(cmd).decode('utf-8')
+        except (subprocess.CalledProcessError, OSError) as e:
+            print('Unable to build the git date index for: {}'.format(repo_root))
+            print(e)
+            return {}
+
+        # git log lists the commits from the newest to the oldest, thus the
+        # first date we see for a file is its latest updated date and the
+        # last one is its creation date
+        date_created = {}
+        date_updated = {}
+        date = None
+        for line in output.splitlines():
+            if line.startswith('\0'):
+                # the ISO 8601 format starts with YYYY-MM-DD
+                date = line[1:11]
+            elif line:
+                path = os.path.join(repo_root, line)
+                date_created[path] = date
+                date_updated.setdefault(path, date)
+
+        date_index = {path: (date_created[path], date_updated[path])
+                      for path in date_created}
+        return date_index
+
     def convert(self, path):
         """
         Convert the input path's notebook to a knowledge repo. This
@@ -112,45 +319,60 @@ class IpynbConverter:
 
         Returns
         -------
-        notebook : dict
-            Updated Jupyter notebook's raw json represented in dictionary format.
-            Ready to be passed to the .add method to add to the knowledge repo.
+        notebook : bytes
+            Updated Jupyter notebook's raw json. Ready to be passed
+            to the .add method to add to the knowledge repo.
         """
         self.date_created_ = self._date_created(path)
         self.date_updated_ = self._date_updated(path)
         self.tags_, self.github_link_ = self._tags_and_github_link(path)
-        with open(path, encoding='utf-8') as f:
-            notebook = json.load(f)
 
-        self.title_ = self._title(notebook)
+        with open(path, 'rb') as f:
+            notebook = f.read()
+
+        self.title_ = self._title(self._cell_first_lines(notebook))
 
         # prepend the dictionary header to notebook['cells']
-        notebook['cells'] = ([self._construct_header()] +
-                             [self._construct_github_link_cell()] +
-                             notebook['cells'])
+        cells = [self._construct_header(), self._construct_github_link_cell()]
+        notebook = self._prepend_cells(notebook, cells)
+
+        # the converted copy sits next to the original notebook, so the
+        # notebook's relative image paths still resolve for the knowledge repo
         if not self.inplace:
-            head, ext = os.path.splitext(path)
-            head += '-converted'
-            path = head + ext
+            path = _converted_path(path)
 
         self._path = path
         return notebook
 
     def _date_created(self, path):
         """Grab the date of creation through git log."""
-        cmd = 'git log --diff-filter=A --follow --format=%cd -1 -- {}'.format(path)
+        if self.date_index is not None and path in self.date_index:
+            return self.date_index[path][0]
+
+        # slow path for notebooks outside of the date index,
+        # --follow traces the notebook's history across renames
+        cmd = ['git', '-C', os.path.dirname(path), 'log',
+               '--diff-filter=A', '--follow', '--format=%cI', '-1', '--', path]
         return self._git_date_cmd(cmd)
 
     def _date_updated(self, path):
         """Grab the last date modified through git log."""
-        cmd = 'git log --format=%cd -1 -- {}'.format(path)
+        if self.date_index is not None and path in self.date_index:
+            return self.date_index[path][1]
+
+        cmd = ['git', '-C', os.path.dirname(path), 'log', '--format=%cI', '-1', '--', path]
         return self._git_date_cmd(cmd)
 
     def _git_date_cmd(self, cmd):
-        """Run bash command to retrieve and format date string."""
-        date_str = subprocess.check_output(cmd, shell=True)
-        date_dt = date_parser.parse(date_str)
-        formatted_date = date_dt.strftime(self.DATE_FORMAT)
+        """Run git command to retrieve and format date string."""
+        import subprocess
+
+        date_str = subprocess.check_output(cmd).decode('utf-8')
+        if not date_str:
+            raise ValueError('No git history found with: {}'.format(' '.join(cmd)))
+
+        # the ISO 8601 format starts with YYYY-MM-DD
+        formatted_date = date_str[:10]
         return formatted_date
 
     def _tags_and_github_link(self, path):
@@ -158,75 +380,74 @@ class IpynbConverter:
         Use file name as tags, e.g. /Users/ethen/machine-learning/trees/decision_tree.ipynb
         we would use 'decision_tree' as the tag
         """
-        _, file_path = path.split(self.REPO_NAME)
-        _, file_name = os.path.split(file_path)
-        tags, _ = os.path.splitext(file_name)
+        file_path = os.path.relpath(os.path.abspath(path), self._repo_prefix)
+        if file_path == os.pardir or file_path.startswith(os.pardir + os.sep):
+            raise ValueError('{} is not under {}'.format(path, self._repo_prefix))
 
-        # /blob/master indicates github master branch
-        link = self.BASE_URL + self.REPO_NAME + '/blob/master' + file_path
+        tags = os.path.basename(file_path)[:-len('.ipynb')]
+        link = self._base_link + '/' + file_path.replace(os.sep, '/')
         return tags, link
 
-    def _title(self, notebook):
+    def _cell_first_lines(self, notebook):
+        """
+        Stream through the notebook's raw json and yield each cell's
+        (cell_type, first line of the source). Only the parser events are
+        walked, so the cells' outputs are never built as python objects.
+        """
+        import ijson
+
+        cell_type = first_line = None
+        for prefix, event, value in ijson.parse(io.BytesIO(notebook)):
+            if prefix == 'cells.item':
+                if event == 'start_map':
+                    cell_type = first_line = None
+                elif event == 'end_map':
+                    yield cell_type, first_line
+            elif prefix == 'cells.item.cell_type':
+                cell_type = value
+            elif prefix == 'cells.item.source.item':
+                if first_line is None:
+                    first_line = value
+            elif prefix == 'cells.item.source' and event == 'string':
+                # the source can also be stored as a single string
+                first_line = value.splitlines(True)[0] if value else None
+
+    def _title(self, cells):
         """
         A title in the notebook always starts with the '#' indicating a
         markdown level 1 header e.g. # Decision Tree (Classification)\n
         thus we can just parse all the text in between the '#' and the line break '\n'
         """
 
-        # TODO : we could fall back to the file path if it doesn't exist perhaps?
-        title_pattern = re.compile('# (.*)\n')
-        for cell in notebook['cells']:
-            if cell['cell_type'] == 'markdown':
-                # the [0] indicates the # title pattern
-                # should always appear in the first line
-                source = cell['source'][0]
-                matched = title_pattern.match(source)
-                if matched is not None:
-                    title = matched.group(1)
+        n_markdown = 0
+        for cell_type, first_line in cells:
+            if cell_type == 'markdown':
+                n_markdown += 1
+                if n_markdown > self.TITLE_MAX_MARKDOWN_CELLS:
+                    break
+
+                # the title pattern should always appear in the first line
+                if first_line is not None and first_line.startswith('# '):
+                    title = first_line[2:].rstrip('\n')
                     # newer version of notebooks includes a
                     # Table of Contents automatically in the first
                     # cell, skip that and find the next level 1 header
                     if not title == 'Table of Contents':
-                        break
-        return title
+                        return title
+
+        # fall back to the file name, which is also used as the tag
+        return self.tags_
 
     def _construct_header(self):
         """Create a knowledge repo style header as a dictionary."""
-
-        def flatten_list(l):
-            """
-            Although not needed for the current version, we could
-            have multiple tags and authors, in that case we would
-            need to flatten them out.
-            """
-            flat = []
-            for item in l:
-                if isinstance(item, list):
-                    flat += item
-                else:
-                    flat.append(item)
-
-            return flat
-
         header = {'cell_type': 'raw', 'metadata': {}}
-
-        # header text required by the knowledge repo
-        # a '- ' in front is required for knowledge repo tag
-        header_text = [
-            '---',
-            'title: {}'.format(self.title_),
-            'authors:',
-            '- {}'.format(self.AUTHOR),
-            'tags:',
-            '- ' + self.tags_,
-            'created_at: {}'.format(self.date_created_),
-            'updated_at: {}'.format(self.date_updated_),
-            'tldr: Nothing for tldr section as of now.',
-            '---']
-
-        header_text = flatten_list(header_text)
-        header_text = [text + '\n' for text in header_text[:-1]] + [header_text[-1]]
-        header['source'] = header_text
+        fields = {
+            'title': self.title_,
+            'author': self.AUTHOR,
+            'tags': self.tags_,
+            'date_created': self.date_created_,
+            'date_updated': self.date_updated_}
+        header['source'] = [text.format_map(fields) for text in self.HEADER_TEMPLATE]
         return header
 
     def _construct_github_link_cell(self):
@@ -234,35 +455,88 @@ class IpynbConverter:
         github_link_cell = {
             'cell_type': 'markdown',
             'metadata': {},
-            'source': ['Link to original notebook: {}'.format(self.github_link_)]}
+            'source': [self.GITHUB_LINK_PREFIX + self.github_link_]}
         return github_link_cell
 
+    def _prepend_cells(self, notebook, cells):
+        """
+        Splice the cells in front of the notebook's raw json cells list,
+        leaving the rest of the notebook's bytes untouched.
+        """
+        matched = self.CELLS_PATTERN.match(notebook)
+        if matched is None:
+            raise ValueError("Notebook's first top-level key is not a cells list")
+
+        start = matched.end()
+        # orjson serializes straight to utf-8 bytes, fall back
+        # to the standard library if it isn't installed
+        orjson = _import_orjson()
+        if orjson is not None:
+            cells_json = orjson.dumps(cells)[1:-1]
+        else:
+            cells_json = json.dumps(cells, ensure_ascii=False)[1:-1].encode('utf-8')
+
+        if self.EMPTY_CELLS_PATTERN.match(notebook, start) is None:
+            cells_json += b','
+
+        return notebook[:start] + cells_json + notebook[start:]
+
     def add(self, notebook):
         """
-        Add the converted notebook to the knowledge repo.
+        Write out the converted notebook, so it can be
+        added to the knowledge repo by the .flush method.
 
         Parameters
         ----------
-        notebook : dict
-            Jupyter notebook's raw json represented in dictionary format.
+        notebook : bytes
+            Jupyter notebook's raw json.
+
+        Returns
+        -------
+        entry : tuple
+            The written notebook's (path, destination, inplace),
+            to be passed on to the .flush method.
         """
-        with open(self._path, 'w', encoding='utf-8') as f:
-            json.dump(notebook, f)
+        with open(self._path, 'wb') as f:
+            f.write(notebook)
 
-        # create a run knowledge repo command
+        # the notebook is added along with all the others in .flush
         destination = os.path.join(self.knowledge_repo_path, 'project', self.tags_)
-        cmd = 'knowledge_repo --repo {} add {} -p {}'.format(
-            self.knowledge_repo_path, self._path, destination)
+        return self._path, destination, self.inplace
 
-        # communicate with the shell output to enable
-        # continuation of the script execution
-        p = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-            stderr=subprocess.STDOUT, shell=True)
-        p.communicate(input=b'generated by automated airbnb knowledge repo setup')
+    @classmethod
+    def flush(cls, knowledge_repo_path, entries):
+        """
+        Add all the converted notebooks to the knowledge repo, opening
+        the knowledge repo once instead of once per notebook.
 
-        if not self.inplace:
-            os.remove(self._path)
+        Parameters
+        ----------
+        knowledge_repo_path : str
+            Path to store the airbnb knowledge repo-ed notebook.
+
+        entries : list[tuple]
+            The converted notebooks' (path, destination, inplace),
+            as returned by the .add method.
+        """
+        try:
+            # knowledge_repo is only needed here and is slow to import
+            from knowledge_repo import KnowledgePost, KnowledgeRepository
+
+            repo = KnowledgeRepository.for_uri(knowledge_repo_path)
+            for path, destination, _ in entries:
+                try:
+                    post = KnowledgePost.from_file(path, format='ipynb')
+                    repo.add(post, path=destination, message=cls.COMMIT_MESSAGE)
+                except Exception as e:
+                    print('Skipping: {}'.format(path))
+                    print(e)
+        finally:
+            # the '-converted' copies are removed even if the
+            # knowledge repo couldn't be opened at all
+            for path, _, inplace in entries:
+                if not inplace and os.path.exists(path):
+                    os.remove(path)
 
 
 if __name__ == '__main__':